@@ -18,16 +18,23 @@ httpx==0.27.0
 google-genai==1.2.0
 python-multipart==0.0.20
 huggingface-hub==0.33.2
+hf_transfer==0.1.9
 python-dotenv==1.1.1
 """
 import os
 import io
-import math
+import errno
 import sqlite3
-import shutil
 import tempfile
+import hashlib
+import zipfile
+import string
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+from urllib.parse import quote
 from fastapi import FastAPI, Form, Request, Response, Depends
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.gzip import GZipMiddleware
@@ -36,25 +43,51 @@ import httpx
 import json
 import random
 import uuid
-from huggingface_hub import HfApi
+import importlib.util
+# hf_transfer is a Rust backend that parallelizes LFS transfers. huggingface_hub
+# reads this flag at import time and fails if it is set without the package installed.
+if importlib.util.find_spec("hf_transfer"):
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+from huggingface_hub import HfApi, CommitOperationAdd, CommitOperationDelete
 from google import genai
 from google.genai import types
 from typing import List, Optional
 import asyncio
-from jinja2 import Environment, BaseLoader, Template
-import glob
+from jinja2 import Environment, DictLoader, FileSystemBytecodeCache
 from PIL import Image
 from tqdm import tqdm
 from tqdm.asyncio import tqdm as atqdm
 
+try:
+    # Optional: libvips streams the decode and uses SIMD resamplers for thumbnails.
+    import pyvips
+except ImportError:
+    pyvips = None
+
 # --- Configuration Constants ---
 DATA_PATH = "data"
 LOCAL_DATABASE_PATH = f"{DATA_PATH}/wallpapers.db"
 LOCAL_WALLPAPER_PATH = f"{DATA_PATH}/wp"
+# Kept outside LOCAL_WALLPAPER_PATH so encoded variants are never archived or synced.
+IMAGE_CACHE_PATH = f"{DATA_PATH}/cache"
 ARCHIVE_BASE_NAME = f"{DATA_PATH}/wp_archive"
 ARCHIVE_FORMAT = "zip"
 ARCHIVE_SPLIT_SIZE_MB = 4500 # 4.5 GB
+HF_MAX_FILE_SIZE_MB = 50_000 # Hugging Face LFS per-file limit (50 GB)
+HF_UPLOAD_THREADS = 8
 PROMPT_BATCH_SIZE = 50
+DB_INSERT_BATCH_SIZE = 500
+WALLPAPER_CONCURRENCY = 8
+WEB_WALLPAPER_CONCURRENCY = 4 # Shared by all /generate requests so they can't pile onto the image API
+WEB_MAX_IMAGES_PER_REQUEST = 25 # /generate clamps num_images to this; the CLI --num is not limited
+GALLERY_THUMBNAIL_SIZE = 240 # Matches the ?resize= used by IMAGE_GALLERY_PARTIAL
+IMAGE_VARIANT_SIZES = (0, GALLERY_THUMBNAIL_SIZE) # The only ?resize= values /wp serves; 0 is full size
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_MIN_VERSION = (3, 35, 0) # UPSERT ... RETURNING in UPSERT_TOPIC_SQL
+SQLITE_OPTIMIZE_INTERVAL_SECONDS = 15 * 60
+DB_POOL_SIZE = 8
+DB_POOL_DRAIN_TIMEOUT_SECONDS = 600 # A /generate request holds its connection while images render
+FRAGMENT_CACHE_SIZE = 256
 
 # --- Environment Variables ---
 IMAGE_GENERATOR_URL_TEMPLATE = os.getenv("IMAGE_GENERATOR_URL_TEMPLATE")
@@ -101,7 +134,7 @@ class Log:
     def highlight(value):
         return f"{Log.BOLD}{Log.OKBLUE}{value}{Log.ENDC}"
 
-INDEX_TEMPLATE = Template("""
+INDEX_TEMPLATE_SOURCE = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -146,7 +179,7 @@ INDEX_TEMPLATE = Template("""
  </div>
  <div class="mb-6">
  <label for="num_images" class="block text-sm font-medium text-gray-300 mb-1">Number of Images</label>
- <input type="number" id="num_images" name="num_images" value="10" min="1" max="100" required
+ <input type="number" id="num_images" name="num_images" value="10" min="1" max="{{ max_images }}" required
  class="w-full bg-gray-700 border border-gray-600 rounded-md p-2 focus:ring-cyan-500 focus:border-cyan-500 transition">
  </div>
  <button type="submit" class="w-full bg-cyan-600 hover:bg-cyan-700 text-white font-bold py-2 px-4 rounded-md transition duration-300 ease-in-out flex items-center justify-center">
@@ -197,9 +230,9 @@ INDEX_TEMPLATE = Template("""
  </div>
 </body>
 </html>
-""")
+"""
 
-TOPIC_LIST_PARTIAL = Template("""
+TOPIC_LIST_PARTIAL_SOURCE = """
 <div id="topic-list-container">
     <div id="topic-list" class="space-y-2">
         {% for topic in topics %}
@@ -214,29 +247,29 @@ TOPIC_LIST_PARTIAL = Template("""
         {% endfor %}
     </div>
 
-    {% if total_pages > 1 %}
+    {% if has_prev or has_next %}
     <div class="flex justify-center items-center space-x-4 mt-6 pt-4 border-t border-gray-700">
-        <a hx-get="/api/topic?page={{ current_page - 1 }}"
+        <a {% if has_prev %}hx-get="/api/topic?page={{ current_page - 1 }}&before_name={{ prev_cursor|urlencode }}"{% endif %}
            hx-target="#topic-list-container"
            hx-swap="outerHTML"
-           class="px-4 py-2 bg-gray-600 rounded-md text-sm font-medium hover:bg-gray-500 cursor-pointer {{ 'opacity-50 !cursor-not-allowed' if current_page == 1 else '' }}">
+           class="px-4 py-2 bg-gray-600 rounded-md text-sm font-medium hover:bg-gray-500 cursor-pointer {{ '' if has_prev else 'opacity-50 !cursor-not-allowed' }}">
             &laquo; Previous
         </a>
         <span class="text-sm text-gray-400">
-            Page {{ current_page }} of {{ total_pages }}
+            Page {{ current_page }}
         </span>
-        <a hx-get="/api/topic?page={{ current_page + 1 }}"
+        <a {% if has_next %}hx-get="/api/topic?page={{ current_page + 1 }}&after_name={{ next_cursor|urlencode }}"{% endif %}
            hx-target="#topic-list-container"
            hx-swap="outerHTML"
-           class="px-4 py-2 bg-gray-600 rounded-md text-sm font-medium hover:bg-gray-500 cursor-pointer {{ 'opacity-50 !cursor-not-allowed' if current_page == total_pages else '' }}">
+           class="px-4 py-2 bg-gray-600 rounded-md text-sm font-medium hover:bg-gray-500 cursor-pointer {{ '' if has_next else 'opacity-50 !cursor-not-allowed' }}">
             Next &raquo;
         </a>
     </div>
     {% endif %}
 </div>
-""")
+"""
 
-IMAGE_GALLERY_PARTIAL = Template("""
+IMAGE_GALLERY_PARTIAL_SOURCE = """
 <div class="bg-gray-800 p-6 rounded-lg shadow-lg" 
      x-data="{% raw %}{ open: false, imageUrl: '' }{% endraw %}"
      x-init="console.log('Alpine component for gallery {{ topic_name }} initialized.')">
@@ -258,19 +291,19 @@ IMAGE_GALLERY_PARTIAL = Template("""
         {% endfor %}
     </div>
 
-    {% if total_pages > 1 %}
+    {% if has_prev or has_next %}
     <div class="flex justify-center items-center space-x-4 mt-6 pt-4 border-t border-gray-700">
-        <a hx-get="/api/topics/{{ topic_id }}/images?page={{ current_page - 1 }}"
+        <a {% if has_prev %}hx-get="/api/topics/{{ topic_id }}/images?page={{ current_page - 1 }}&after_created_at={{ prev_cursor.created_at|urlencode }}&after_id={{ prev_cursor.id }}"{% endif %}
            hx-target="#gallery-view" hx-swap="innerHTML"
-           class="px-4 py-2 bg-gray-600 rounded-md text-sm font-medium hover:bg-gray-500 cursor-pointer {{ 'opacity-50 !cursor-not-allowed' if current_page == 1 else '' }}">
+           class="px-4 py-2 bg-gray-600 rounded-md text-sm font-medium hover:bg-gray-500 cursor-pointer {{ '' if has_prev else 'opacity-50 !cursor-not-allowed' }}">
             &laquo; Previous
         </a>
         <span class="text-sm text-gray-400">
             Page {{ current_page }} of {{ total_pages }}
         </span>
-        <a hx-get="/api/topics/{{ topic_id }}/images?page={{ current_page + 1 }}"
+        <a {% if has_next %}hx-get="/api/topics/{{ topic_id }}/images?page={{ current_page + 1 }}&before_created_at={{ next_cursor.created_at|urlencode }}&before_id={{ next_cursor.id }}"{% endif %}
            hx-target="#gallery-view" hx-swap="innerHTML"
-           class="px-4 py-2 bg-gray-600 rounded-md text-sm font-medium hover:bg-gray-500 cursor-pointer {{ 'opacity-50 !cursor-not-allowed' if current_page == total_pages else '' }}">
+           class="px-4 py-2 bg-gray-600 rounded-md text-sm font-medium hover:bg-gray-500 cursor-pointer {{ '' if has_next else 'opacity-50 !cursor-not-allowed' }}">
             Next &raquo;
         </a>
     </div>
@@ -292,57 +325,388 @@ IMAGE_GALLERY_PARTIAL = Template("""
         </div>
     </div>
 </div>
-""")
+"""
+
+# One shared environment: templates are compiled once, cached in memory,
+# and their bytecode is persisted so restarts (e.g. under --reload) skip compilation.
+TEMPLATE_ENV = Environment(
+    loader=DictLoader({
+        "index.html": INDEX_TEMPLATE_SOURCE,
+        "topic_list.html": TOPIC_LIST_PARTIAL_SOURCE,
+        "image_gallery.html": IMAGE_GALLERY_PARTIAL_SOURCE,
+    }),
+    bytecode_cache=FileSystemBytecodeCache(),
+    auto_reload=False,
+    cache_size=400,
+)
+INDEX_TEMPLATE = TEMPLATE_ENV.get_template("index.html")
+TOPIC_LIST_PARTIAL = TEMPLATE_ENV.get_template("topic_list.html")
+IMAGE_GALLERY_PARTIAL = TEMPLATE_ENV.get_template("image_gallery.html")
+# The shell page has no per-request variables, so it is rendered exactly once.
+INDEX_HTML = INDEX_TEMPLATE.render(max_images=WEB_MAX_IMAGES_PER_REQUEST)
 
 # --- Database Logic ---
-def get_db():
-    db = sqlite3.connect(LOCAL_DATABASE_PATH, check_same_thread=False)
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS topic (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS image (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic_id INTEGER,
+    image TEXT NOT NULL UNIQUE,
+    prompt TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    seed INTEGER,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    notes TEXT,
+    is_favorite INTEGER DEFAULT 0,
+    FOREIGN KEY (topic_id) REFERENCES topic (id)
+);
+-- ORDER BY name is served by topic.name's UNIQUE autoindex. The gallery's
+-- ORDER BY created_at DESC, id DESC is served by idx_image_topic_created,
+-- which supersedes idx_image_topic.
+DROP INDEX IF EXISTS idx_image_topic;
+CREATE INDEX IF NOT EXISTS idx_image_topic_created ON image(topic_id, created_at DESC, id DESC);
+-- Per-topic image totals, kept current by triggers so the gallery never runs COUNT(*).
+CREATE TABLE IF NOT EXISTS topic_stats (
+    topic_id INTEGER PRIMARY KEY,
+    image_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS image_ai AFTER INSERT ON image WHEN NEW.topic_id IS NOT NULL BEGIN
+    INSERT INTO topic_stats (topic_id, image_count) VALUES (NEW.topic_id, 1)
+    ON CONFLICT(topic_id) DO UPDATE SET image_count = image_count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS image_ad AFTER DELETE ON image BEGIN
+    UPDATE topic_stats SET image_count = image_count - 1 WHERE topic_id = OLD.topic_id;
+END;
+-- A move is split in two so that moving an image to a NULL topic still decrements the old one.
+DROP TRIGGER IF EXISTS image_au;
+CREATE TRIGGER IF NOT EXISTS image_au_old AFTER UPDATE OF topic_id ON image BEGIN
+    UPDATE topic_stats SET image_count = image_count - 1 WHERE topic_id = OLD.topic_id;
+END;
+CREATE TRIGGER IF NOT EXISTS image_au_new AFTER UPDATE OF topic_id ON image WHEN NEW.topic_id IS NOT NULL BEGIN
+    INSERT INTO topic_stats (topic_id, image_count) VALUES (NEW.topic_id, 1)
+    ON CONFLICT(topic_id) DO UPDATE SET image_count = image_count + 1;
+END;
+-- Resync on every init: a database pulled from the Hub may have been written without the triggers.
+-- One transaction, so a concurrent reader never sees the emptied table.
+BEGIN;
+DELETE FROM topic_stats;
+INSERT INTO topic_stats (topic_id, image_count) SELECT topic_id, COUNT(*) FROM image WHERE topic_id IS NOT NULL GROUP BY topic_id;
+COMMIT;
+"""
+
+# The no-op DO UPDATE makes RETURNING yield the id for existing topics too (SQLite >= 3.35).
+UPSERT_TOPIC_SQL = "INSERT INTO topic (name) VALUES (?) ON CONFLICT(name) DO UPDATE SET name = excluded.name RETURNING id"
+INSERT_IMAGE_SQL = "INSERT OR IGNORE INTO image (topic_id, image, prompt, width, height, seed) VALUES (?, ?, ?, ?, ?, ?)"
+TOPIC_NAME_SQL = "SELECT name FROM topic WHERE id = ?"
+
+# Page queries end with LIMIT ? and select only what the partials render plus the keyset cursor columns.
+# The topic list shows Prev/Next only, so it never needs a COUNT(*) over topic.
+TOPICS_FIRST_PAGE_SQL = "SELECT id, name FROM topic ORDER BY name LIMIT ?"
+TOPICS_PAGE_AFTER_SQL = "SELECT id, name FROM topic WHERE name > ? ORDER BY name LIMIT ?"
+TOPICS_PAGE_BEFORE_SQL = "SELECT id, name FROM topic WHERE name < ? ORDER BY name DESC LIMIT ?"
+
+# Gallery queries also take a {total_column} slot (see fetch_page_with_total).
+# Newest first; id breaks ties between equal timestamps so the cursor never skips or repeats rows.
+IMAGES_COUNT_SQL = "SELECT COALESCE((SELECT image_count FROM topic_stats WHERE topic_id = ?), 0)"
+IMAGES_FIRST_PAGE_SQL = """
+    SELECT id, image, prompt, seed, created_at{total_column} FROM image WHERE topic_id = ?
+    ORDER BY created_at DESC, id DESC LIMIT ?
+"""
+IMAGES_PAGE_BEFORE_SQL = """
+    SELECT id, image, prompt, seed, created_at{total_column} FROM image WHERE topic_id = ? AND (created_at, id) < (?, ?)
+    ORDER BY created_at DESC, id DESC LIMIT ?
+"""
+IMAGES_PAGE_AFTER_SQL = """
+    SELECT id, image, prompt, seed, created_at{total_column} FROM image WHERE topic_id = ? AND (created_at, id) > (?, ?)
+    ORDER BY created_at ASC, id ASC LIMIT ?
+"""
+
+# journal_mode=WAL is persisted in the file by init_db; these only last for one connection.
+SQLITE_CONNECTION_PRAGMAS = (
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456", # 256 MB
+    "PRAGMA cache_size=-65536", # 64 MB, keeps the topic/image indexes resident
+)
+
+def connect_db() -> sqlite3.Connection:
+    # Pooled connections live long, so a larger statement cache keeps every page query prepared.
+    db = sqlite3.connect(LOCAL_DATABASE_PATH, check_same_thread=False, cached_statements=256)
     db.row_factory = sqlite3.Row
+    for pragma in SQLITE_CONNECTION_PRAGMAS:
+        db.execute(pragma)
+    return db
+
+class ConnectionPool:
+    """
+    Keeps up to `size` idle sqlite3 connections for reuse across requests, so
+    each request skips sqlite3_open/PRAGMA setup and SQLite's page cache stays warm.
+    """
+    def __init__(self, factory, size: int):
+        self._factory = factory
+        self._size = size
+        self._idle: List[sqlite3.Connection] = []
+        self._cond = threading.Condition()
+        # close() bumps the generation; connections opened under an older one are
+        # closed when they come back instead of being reused.
+        self._generation = 0
+        self._generations: dict[sqlite3.Connection, int] = {}
+        self._checked_out = 0
+        self._suspended = False
+
+    def acquire(self) -> sqlite3.Connection:
+        with self._cond:
+            self._cond.wait_for(lambda: not self._suspended)
+            self._checked_out += 1
+            if self._idle:
+                return self._idle.pop()
+            generation = self._generation
+        try:
+            db = self._factory()
+        except Exception:
+            self.release(None)
+            raise
+        with self._cond:
+            self._generations[db] = generation
+        return db
+
+    def release(self, db: Optional[sqlite3.Connection]):
+        if db is not None and db.in_transaction:
+            db.rollback()
+        with self._cond:
+            self._checked_out -= 1
+            self._cond.notify_all()
+            if db is None:
+                return
+            if self._generations.get(db) == self._generation and len(self._idle) < self._size:
+                self._idle.append(db)
+                return
+            self._generations.pop(db, None)
+        db.close()
+
+    def warmup(self):
+        """Opens connections until the pool is full, so early requests don't pay for connect_db()."""
+        with self._cond:
+            missing = self._size - len(self._idle)
+            generation = self._generation
+        for _ in range(missing):
+            db = self._factory()
+            with self._cond:
+                self._generations[db] = generation
+                self._idle.append(db)
+
+    def close(self):
+        """Closes idle connections; checked-out ones are closed as they are released."""
+        with self._cond:
+            self._generation += 1
+            idle, self._idle = self._idle, []
+            for db in idle:
+                self._generations.pop(db, None)
+        for db in idle:
+            db.close()
+
+    def suspend(self, timeout: Optional[float] = None) -> bool:
+        """
+        Blocks new acquires, closes the pool and waits for every checked-out connection
+        to be released, so the database file can be swapped. Returns False on timeout;
+        call resume() either way.
+        """
+        with self._cond:
+            self._suspended = True
+        self.close()
+        with self._cond:
+            return self._cond.wait_for(lambda: self._checked_out == 0, timeout)
+
+    def resume(self):
+        with self._cond:
+            self._suspended = False
+            self._cond.notify_all()
+
+DB_POOL = ConnectionPool(connect_db, DB_POOL_SIZE)
+
+def get_db():
+    db = DB_POOL.acquire()
     try:
         yield db
     finally:
-        db.close()
+        DB_POOL.release(db)
 
 def init_db():
-    with sqlite3.connect(LOCAL_DATABASE_PATH) as con:
+    if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+        raise RuntimeError(
+            f"SQLite {'.'.join(map(str, SQLITE_MIN_VERSION))}+ is required, but this Python links "
+            f"SQLite {sqlite3.sqlite_version}. Use a Python build with a newer SQLite."
+        )
+    # Closed explicitly: a lingering connection would block the journal_mode switch after a sync.
+    con = sqlite3.connect(LOCAL_DATABASE_PATH)
+    try:
         cur = con.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS topic (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS image (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                topic_id INTEGER,
-                image TEXT NOT NULL UNIQUE,
-                prompt TEXT NOT NULL,
-                width INTEGER,
-                height INTEGER,
-                seed INTEGER,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                notes TEXT,
-                is_favorite INTEGER DEFAULT 0,
-                FOREIGN KEY (topic_id) REFERENCES topic (id)
-            )
-        """)
+        # WAL lets the web UI read while the CLI generator is writing.
+        cur.execute("PRAGMA journal_mode=WAL")
+        for pragma in SQLITE_CONNECTION_PRAGMAS:
+            cur.execute(pragma)
+        cur.executescript(SCHEMA_SQL)
         con.commit()
+    finally:
+        con.close()
     Log.info("Database initialized.")
 
+async def optimize_db_periodically():
+    """Runs PRAGMA optimize on a fixed interval so query planner stats stay fresh."""
+    while True:
+        await asyncio.sleep(SQLITE_OPTIMIZE_INTERVAL_SECONDS)
+        try:
+            con = sqlite3.connect(LOCAL_DATABASE_PATH)
+            try:
+                con.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+                con.execute("PRAGMA optimize")
+            finally:
+                con.close()
+        except sqlite3.Error as e:
+            Log.warning(f"PRAGMA optimize failed: {e}")
+
+# Handlers are async, so blocking sqlite3 calls go through worker threads
+# (connections are opened with check_same_thread=False).
+async def db_fetchone(db, sql, params=()):
+    return await asyncio.to_thread(lambda: db.execute(sql, params).fetchone())
+
+def fetch_keyset_page(db, sql, params, per_page, reverse=False):
+    """
+    Runs a keyset (seek) page query whose last placeholder is the LIMIT.
+    One extra row is fetched to tell whether more rows exist past this page.
+    Backward pages are queried in reverse order and flipped back here.
+    """
+    rows = db.execute(sql, (*params, per_page + 1)).fetchall()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    return (rows[::-1] if reverse else rows), has_more
+
+# Bumped by in-process writes; see content_version().
+_CONTENT_VERSION = 0
+
+def bump_content_version():
+    global _CONTENT_VERSION
+    _CONTENT_VERSION += 1
+
+def content_version() -> tuple:
+    """
+    Changes whenever the dataset may have changed. Web writes bump the counter,
+    and commits from other processes (the CLI generator) move the mtime/size of
+    the database or its WAL file.
+    """
+    signature = [_CONTENT_VERSION]
+    for path in (LOCAL_DATABASE_PATH, f"{LOCAL_DATABASE_PATH}-wal"):
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+class FragmentCache:
+    """A small LRU of rendered HTML partials, keyed by content_version() plus the request's page/cursor."""
+    def __init__(self, size: int):
+        self._size = size
+        self._entries: "OrderedDict[tuple, str]" = OrderedDict()
+
+    def get(self, key) -> Optional[str]:
+        html = self._entries.get(key)
+        if html is not None:
+            self._entries.move_to_end(key)
+        return html
+
+    def put(self, key, html: str):
+        self._entries[key] = html
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+FRAGMENT_CACHE = FragmentCache(FRAGMENT_CACHE_SIZE)
+
+def stream_fragment(template, fragment_key: tuple, headers: dict, context: dict) -> StreamingResponse:
+    """
+    Streams a partial as Jinja produces it, caching the full HTML once the last chunk is sent.
+    context is handed to Jinja as the one dict it renders from, with no kwargs repacking.
+    """
+    async def chunks():
+        parts = []
+        for chunk in template.generate(context):
+            parts.append(chunk)
+            yield chunk
+        FRAGMENT_CACHE.put(fragment_key, "".join(parts))
+    return StreamingResponse(chunks(), media_type="text/html", headers=headers)
+
+def fragment_etag(fragment_key: tuple) -> str:
+    """Weak ETag for a rendered partial; fragment_key already carries content_version()."""
+    return f'W/"{hashlib.blake2b(repr(fragment_key).encode(), digest_size=16).hexdigest()}"'
+
+@lru_cache(maxsize=None)
+def page_sql_variant(page_sql: str, count_sql: str) -> str:
+    """Fills a page query's {total_column} slot once, so the sqlite3 statement cache sees stable strings."""
+    return page_sql.format(total_column=f", ({count_sql}) AS total_count")
+
+def fetch_page_with_total(db, count_sql, count_params, page_sql, page_params, per_page, reverse=False):
+    """
+    Fetches a keyset page plus the total row count for the page label.
+    page_sql has a {total_column} slot right after its explicit column list.
+    count_sql is placed there as an uncorrelated subquery, which SQLite
+    evaluates once, so the total rides along in the same round trip. It is
+    read fresh every time; the fragment cache already skips this whole call
+    while content_version() is unchanged.
+    """
+    rows, has_more = fetch_keyset_page(
+        db, page_sql_variant(page_sql, count_sql), (*count_params, *page_params), per_page, reverse
+    )
+    # Only an empty page needs the separate COUNT query.
+    total = rows[0]['total_count'] if rows else db.execute(count_sql, count_params).fetchone()[0]
+    return rows, has_more, total
+
 # --- Archive and Sync Logic ---
+COPY_BLOCK_SIZE = 1 << 20 # 1 MiB
+
+def copy_file_bytes(src, dst, count):
+    """Copies up to count bytes from src to dst without holding a whole chunk in memory."""
+    copied = 0
+    if hasattr(os, "sendfile"):
+        # Zero-copy in-kernel transfer; the src file position is advanced manually.
+        offset = src.tell()
+        try:
+            while copied < count:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset + copied, min(1 << 24, count - copied))
+                if sent == 0: break
+                copied += sent
+            src.seek(offset + copied)
+            return copied
+        except OSError as e:
+            # macOS/BSD sendfile only writes to sockets; finish with the block copy below.
+            if e.errno not in (errno.ENOTSOCK, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+            src.seek(offset + copied)
+            dst.seek(0, os.SEEK_END)
+
+    while copied < count:
+        buf = src.read(min(COPY_BLOCK_SIZE, count - copied))
+        if not buf: break
+        dst.write(buf)
+        copied += len(buf)
+    return copied
+
 def split_file(file_path, chunk_size):
     parts = []
+    total_size = os.path.getsize(file_path)
     with open(file_path, 'rb') as f:
         part_num = 0
-        while True:
-            chunk = f.read(chunk_size)
-            if not chunk: break
+        while f.tell() < total_size:
             part_num += 1
             part_filename = f"{file_path}.part{str(part_num).zfill(3)}"
             with open(part_filename, 'wb') as part_file:
-                part_file.write(chunk)
+                copy_file_bytes(f, part_file, chunk_size)
             parts.append(part_filename)
     return parts
 
@@ -350,47 +714,60 @@ def join_files(parts, output_path):
     with open(output_path, 'wb') as output_f:
         for part_path in sorted(parts):
             with open(part_path, 'rb') as part_f:
-                output_f.write(part_f.read())
+                copy_file_bytes(part_f, output_f, os.path.getsize(part_path))
+
+def dir_has_entries(path):
+    """Checks for at least one entry without listing the whole directory."""
+    with os.scandir(path) as entries:
+        return next(entries, None) is not None
+
+def create_archive(archive_path, source_dir):
+    """Zips source_dir without compression; PNGs are already entropy-coded."""
+    with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for root, _, files in os.walk(source_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                zf.write(path, os.path.relpath(path, source_dir))
+
+def extract_archive(archive_path, target_dir):
+    with zipfile.ZipFile(archive_path) as zf:
+        zf.extractall(target_dir)
+
+def copy_database(src_path, dst_path):
+    """
+    Copies a database through SQLite's backup API. Unlike a file copy this includes
+    commits still sitting in the source's -wal, and when dst_path is live it goes
+    through SQLite's locks, so connections in other processes (the CLI, the web
+    server) see the new contents instead of replaying a stale WAL over them.
+    """
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
 
 def merge_databases(local_backup_path, server_db_path):
     Log.info("Starting database merge...")
-    conn_local = sqlite3.connect(local_backup_path)
     conn_server = sqlite3.connect(server_db_path)
-    cur_local = conn_local.cursor()
-    cur_server = conn_server.cursor()
-
-    cur_local.execute("SELECT name FROM topic")
-    for row in cur_local.fetchall():
-        cur_server.execute("INSERT OR IGNORE INTO topic (name) VALUES (?)", (row[0],))
-
-    cur_server.execute("SELECT image FROM image")
-    server_images = {row[0] for row in cur_server.fetchall()}
-
-    cur_local.execute("SELECT * FROM image")
-    local_images = cur_local.fetchall()
-
-    new_images_count = 0
-    for img_row in tqdm(local_images, desc="Merging DB Records"):
-        img_filename = img_row[2]
-        if img_filename not in server_images:
-            cur_local.execute("SELECT name FROM topic WHERE id = ?", (img_row[1],))
-            topic_name_row = cur_local.fetchone()
-            if not topic_name_row: continue
-
-            cur_server.execute("SELECT id FROM topic WHERE name = ?", (topic_name_row[0],))
-            server_topic_id_row = cur_server.fetchone()
-            if not server_topic_id_row: continue
-
-            new_row_data = (server_topic_id_row[0],) + img_row[2:]
-            cur_server.execute("""
-                INSERT INTO image (topic_id, image, prompt, width, height, seed, created_at, updated_at, notes, is_favorite) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, new_row_data)
-            new_images_count += 1
-
-    conn_server.commit()
-    conn_local.close()
-    conn_server.close()
+    # The whole merge runs inside SQLite; image filenames are UNIQUE, so
+    # INSERT OR IGNORE skips records the server already has.
+    try:
+        conn_server.execute("ATTACH DATABASE ? AS local", (local_backup_path,))
+        with conn_server:
+            conn_server.execute("INSERT OR IGNORE INTO topic (name) SELECT name FROM local.topic")
+            cur = conn_server.execute("""
+                INSERT OR IGNORE INTO image (topic_id, image, prompt, width, height, seed, created_at, updated_at, notes, is_favorite)
+                SELECT s.id, li.image, li.prompt, li.width, li.height, li.seed, li.created_at, li.updated_at, li.notes, li.is_favorite
+                FROM local.image li
+                JOIN local.topic lt ON lt.id = li.topic_id
+                JOIN topic s ON s.name = lt.name
+            """)
+            new_images_count = cur.rowcount
+    finally:
+        # Closing also detaches, including when ATTACH itself failed.
+        conn_server.close()
     Log.success(f"Database merge complete. {Log.highlight(new_images_count)} new entries added.")
 
 async def sync_with_huggingface(repo_id: str):
@@ -399,10 +776,11 @@ async def sync_with_huggingface(repo_id: str):
         raise ValueError("Error: HF_SECRET is not set. Cannot authenticate.")
     api = HfApi(token=HF_SECRET)
     try:
-        currentUser = api.whoami()
+        # HfApi and the archive helpers block, so they all run in worker threads.
+        currentUser = await asyncio.to_thread(api.whoami)
         Log.info(f"Successfully authenticated as {Log.highlight(currentUser['name'])}.")
         if currentUser:
-            api.create_repo(repo_id=repo_id, repo_type="dataset", exist_ok=True)
+            await asyncio.to_thread(api.create_repo, repo_id=repo_id, repo_type="dataset", exist_ok=True)
             await _sync_with_huggingface2(api, repo_id)
 
     except Exception as e:
@@ -414,30 +792,22 @@ async def _sync_with_huggingface2(api: HfApi, repo_id: str):
     archive_full_path = f"{ARCHIVE_BASE_NAME}.{ARCHIVE_FORMAT}"
     local_db_backup_path = f"{LOCAL_DATABASE_PATH}.backup"
 
-    Log.info(f"Creating local database backup to {Log.highlight(os.path.basename(local_db_backup_path))}")
-    if os.path.exists(LOCAL_DATABASE_PATH):
-        shutil.copy2(LOCAL_DATABASE_PATH, local_db_backup_path)
-    else:
-        local_db_backup_path = None
-
     with tempfile.TemporaryDirectory() as temp_dir:
         Log.header("Step 1: PULL - Pulling Data From Repository")
         try:
-            with tqdm(total=1, desc="Downloading from HF") as pbar:
-                api.snapshot_download(
-                    repo_id=repo_id,
-                    local_dir=temp_dir,
-                    repo_type="dataset",
-                )
-                pbar.update(1)
+            # huggingface_hub reports real per-file progress on its own.
+            await asyncio.to_thread(
+                api.snapshot_download,
+                repo_id=repo_id,
+                local_dir=temp_dir,
+                repo_type="dataset",
+            )
             Log.success("Data from the repository was successfully downloaded.")
         except Exception as e:
             if "404" in str(e) or "Repo not found" in str(e):
                 Log.warning("Remote repository is empty or not found. Will proceed to PUSH local state.")
             else:
                 Log.error(f"Failed to download from Hugging Face: {e}")
-                if local_db_backup_path and os.path.exists(local_db_backup_path):
-                    os.remove(local_db_backup_path)
                 return
 
         Log.header("Step 2: MERGE & EXTRACT - Merging and Extracting Data")
@@ -445,53 +815,84 @@ async def _sync_with_huggingface2(api: HfApi, repo_id: str):
         remote_db_in_temp = os.path.join(temp_dir, os.path.basename(LOCAL_DATABASE_PATH))
         if os.path.exists(remote_db_in_temp):
             Log.info("Remote database found. Setting it as the base for merging.")
-            shutil.copy2(remote_db_in_temp, LOCAL_DATABASE_PATH)
-        
-        if local_db_backup_path and os.path.exists(local_db_backup_path):
-            merge_databases(local_db_backup_path, LOCAL_DATABASE_PATH)
-            os.remove(local_db_backup_path)
-
-        archive_parts_in_temp = sorted(glob.glob(f"{temp_dir}/{os.path.basename(ARCHIVE_BASE_NAME)}.part*"))
+            # Hold off web requests and wait for in-flight ones, so nothing is using (or
+            # still writing to) the old file while it is backed up and replaced.
+            try:
+                if not await asyncio.to_thread(DB_POOL.suspend, DB_POOL_DRAIN_TIMEOUT_SECONDS):
+                    raise RuntimeError("Timed out waiting for open database connections to finish.")
+                has_local_db = os.path.exists(LOCAL_DATABASE_PATH)
+                if has_local_db:
+                    Log.info(f"Creating local database backup to {Log.highlight(os.path.basename(local_db_backup_path))}")
+                    await asyncio.to_thread(copy_database, LOCAL_DATABASE_PATH, local_db_backup_path)
+                await asyncio.to_thread(copy_database, remote_db_in_temp, LOCAL_DATABASE_PATH)
+                # The remote copy may predate the current schema; bring its indexes and counters up to date.
+                await asyncio.to_thread(init_db)
+            finally:
+                DB_POOL.resume()
+
+            if has_local_db:
+                await asyncio.to_thread(merge_databases, local_db_backup_path, LOCAL_DATABASE_PATH)
+                os.remove(local_db_backup_path)
+
+        temp_archive_full_path = os.path.join(temp_dir, f"{os.path.basename(ARCHIVE_BASE_NAME)}.{ARCHIVE_FORMAT}")
+        part_prefix = f"{os.path.basename(ARCHIVE_BASE_NAME)}.part"
+        with os.scandir(temp_dir) as entries:
+            archive_parts_in_temp = sorted(e.path for e in entries if e.name.startswith(part_prefix))
         if archive_parts_in_temp:
             Log.info(f"Found {Log.highlight(len(archive_parts_in_temp))} remote archive parts. Joining...")
-            temp_archive_full_path = os.path.join(temp_dir, f"{os.path.basename(ARCHIVE_BASE_NAME)}.{ARCHIVE_FORMAT}")
-            join_files(archive_parts_in_temp, temp_archive_full_path)
-            
+            await asyncio.to_thread(join_files, archive_parts_in_temp, temp_archive_full_path)
+        elif os.path.exists(temp_archive_full_path):
+            Log.info("Found a single remote archive.")
+
+        if os.path.exists(temp_archive_full_path):
             Log.info(f"Merging remote images by extracting archive to {Log.highlight(LOCAL_WALLPAPER_PATH)}...")
-            shutil.unpack_archive(temp_archive_full_path, LOCAL_WALLPAPER_PATH, format=ARCHIVE_FORMAT)
+            await asyncio.to_thread(extract_archive, temp_archive_full_path, LOCAL_WALLPAPER_PATH)
             
             Log.success("Extraction of remote archive complete.")
         else:
             Log.info("No remote image archives found to extract.")
 
     Log.header("Step 3: PUSH - Pushing Data To Repository")
-    if os.path.exists(LOCAL_WALLPAPER_PATH) and os.listdir(LOCAL_WALLPAPER_PATH):
+    if os.path.exists(LOCAL_WALLPAPER_PATH) and dir_has_entries(LOCAL_WALLPAPER_PATH):
         Log.info(f"Creating archive from the merged {Log.highlight('wp')} folder...")
-        shutil.make_archive(ARCHIVE_BASE_NAME, ARCHIVE_FORMAT, LOCAL_WALLPAPER_PATH)
+        await asyncio.to_thread(create_archive, archive_full_path, LOCAL_WALLPAPER_PATH)
         
-        Log.info("Splitting archive if necessary...")
-        parts_to_upload = split_file(archive_full_path, chunk_size)
-        Log.info(f"Archive split into {Log.highlight(len(parts_to_upload))} parts.")
+        if os.path.getsize(archive_full_path) > HF_MAX_FILE_SIZE_MB * 1024 * 1024:
+            Log.info("Archive exceeds the Hugging Face file size limit. Splitting...")
+            parts_to_upload = await asyncio.to_thread(split_file, archive_full_path, chunk_size)
+            Log.info(f"Archive split into {Log.highlight(len(parts_to_upload))} parts.")
+        else:
+            parts_to_upload = [archive_full_path]
     else:
         parts_to_upload = []
 
-    repo_files = api.list_repo_files(repo_id=repo_id, repo_type="dataset")
-    old_parts = [f for f in repo_files if f.startswith(os.path.basename(ARCHIVE_BASE_NAME))]
-    if old_parts:
-        Log.info(f"Deleting {Log.highlight(len(old_parts))} old archives from the repository...")
-        api.delete_files(repo_id=repo_id, delete_patterns=old_parts, repo_type="dataset", commit_message="Sync: Delete old archives")
-
-    with tqdm(total=len(parts_to_upload) + 1, desc="Uploading to HF") as pbar:
-        for i, part_path in enumerate(parts_to_upload):
-            part_filename = os.path.basename(part_path)
-            pbar.set_description(f"Uploading part {i+1}/{len(parts_to_upload)}")
-            api.upload_file(path_or_fileobj=part_path, path_in_repo=part_filename, repo_id=repo_id, repo_type="dataset")
-            pbar.update(1)
-        
-        pbar.set_description("Uploading database")
-        api.upload_file(path_or_fileobj=LOCAL_DATABASE_PATH, path_in_repo="wallpapers.db", repo_id=repo_id, repo_type="dataset", commit_message="Sync: Upload database")
-        pbar.update(1)
+    # Upload a snapshot, so the pushed file includes commits not yet checkpointed out of the -wal.
+    db_upload_path = f"{LOCAL_DATABASE_PATH}.upload"
+    await asyncio.to_thread(copy_database, LOCAL_DATABASE_PATH, db_upload_path)
+
+    operations = [
+        CommitOperationAdd(path_in_repo=os.path.basename(part_path), path_or_fileobj=part_path)
+        for part_path in parts_to_upload
+    ]
+    operations.append(CommitOperationAdd(path_in_repo="wallpapers.db", path_or_fileobj=db_upload_path))
+    # Re-uploaded paths are simply overwritten; only archives that no longer exist locally are deleted.
+    new_paths = {op.path_in_repo for op in operations}
+    repo_files = await asyncio.to_thread(api.list_repo_files, repo_id=repo_id, repo_type="dataset")
+    old_parts = [f for f in repo_files if f.startswith(os.path.basename(ARCHIVE_BASE_NAME)) and f not in new_paths]
+    operations.extend(CommitOperationDelete(path_in_repo=f) for f in old_parts)
+
+    # One commit: the archive files upload in parallel, and the repo never holds a partial set of parts.
+    Log.info(f"Uploading {Log.highlight(len(parts_to_upload))} archive file(s) and the database, deleting {Log.highlight(len(old_parts))} old archive(s)...")
+    await asyncio.to_thread(
+        api.create_commit,
+        repo_id=repo_id,
+        repo_type="dataset",
+        operations=operations,
+        commit_message="Sync: Upload archives and database",
+        num_threads=HF_UPLOAD_THREADS,
+    )
 
+    os.remove(db_upload_path)
     if os.path.exists(archive_full_path):
         os.remove(archive_full_path)
     for part in parts_to_upload:
@@ -552,6 +953,7 @@ Now, provide the first batch of {PROMPT_BATCH_SIZE} prompts.
     )
 
     all_prompts = []
+    seen = set() # The AI is asked to avoid duplicates; this enforces it before any image is generated.
     
     try:
         with atqdm(total=num_prompts, desc="Generating Prompts") as pbar:
@@ -573,7 +975,10 @@ Now, provide the first batch of {PROMPT_BATCH_SIZE} prompts.
 
                 # Calculate how many prompts to take from this batch
                 remaining_needed = num_prompts - len(all_prompts)
-                to_add = current_batch[:remaining_needed]
+                fresh = [p for p in current_batch if not (p in seen or seen.add(p))]
+                if len(fresh) < len(current_batch):
+                    Log.warning(f"Skipped {len(current_batch) - len(fresh)} duplicate prompts from the AI.")
+                to_add = fresh[:remaining_needed]
 
                 all_prompts.extend(to_add)
                 pbar.update(len(to_add))
@@ -591,21 +996,109 @@ Now, provide the first batch of {PROMPT_BATCH_SIZE} prompts.
         Log.success(f"Chat Session Finished. A total of {len(all_prompts)} prompts were successfully created.")
         return all_prompts[:num_prompts]
 
-async def generate_wallpaper(prompt: str, width: int, height: int) -> Optional[tuple[str, int]]:
+# --- Image Variant Logic ---
+def image_cache_path(image: str, resize_val: int, fmt: str) -> str:
+    cache_key = hashlib.sha1(image.encode()).hexdigest()
+    return os.path.join(IMAGE_CACHE_PATH, f"{cache_key}_{resize_val}.{fmt}")
+
+def open_thumbnail(img_path: str, resize_val: int) -> Image.Image:
+    """Opens an image, downscaled to fit resize_val when it is non-zero."""
+    img = Image.open(img_path)
+    if resize_val:
+        # Lets decoders that support it (e.g. JPEG) read at reduced resolution.
+        img.draft(None, (resize_val * 2, resize_val * 2))
+        img.thumbnail((resize_val, resize_val), Image.Resampling.LANCZOS)
+    return img
+
+def render_image_variant(img_path: str, resize_val: int, fmt: str, cache_path: str):
+    """Encodes one (size, format) variant of a wallpaper into the on-disk cache."""
+    os.makedirs(IMAGE_CACHE_PATH, exist_ok=True)
+    if pyvips and resize_val:
+        thumb = pyvips.Image.thumbnail(img_path, resize_val)
+        buffer = thumb.write_to_buffer(".webp[Q=80]" if fmt == "webp" else ".png")
+        with tempfile.NamedTemporaryFile(dir=IMAGE_CACHE_PATH, suffix=f".{fmt}", delete=False) as tmp:
+            tmp.write(buffer)
+        os.replace(tmp.name, cache_path)
+        return
+
+    img = open_thumbnail(img_path, resize_val)
+    # Write to a temp file first so concurrent requests never see a partial image.
+    with tempfile.NamedTemporaryFile(dir=IMAGE_CACHE_PATH, suffix=f".{fmt}", delete=False) as tmp:
+        try:
+            if fmt == "webp":
+                # The 'quality' parameter (1-100) adjusts compression. 80 is a good balance.
+                img.save(tmp, format="WEBP", quality=80, method=6)
+            else:
+                img.save(tmp, format="PNG")
+        except Exception:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    os.replace(tmp.name, cache_path)
+
+def ensure_image_variant(image: str, resize_val: int, fmt: str) -> str:
+    """Returns the cached variant path, encoding it first on a cache miss."""
+    cache_path = image_cache_path(image, resize_val, fmt)
+    if not os.path.exists(cache_path):
+        render_image_variant(os.path.join(LOCAL_WALLPAPER_PATH, image), resize_val, fmt, cache_path)
+    return cache_path
+
+@lru_cache(maxsize=512) # ~20-80 KB per thumbnail, so roughly 40 MB at most
+def load_image_variant(image: str, resize_val: int, fmt: str) -> bytes:
+    """
+    Encoded variant bytes, memoized in process. Wallpapers are immutable; call
+    load_image_variant.cache_clear() if files in LOCAL_WALLPAPER_PATH are ever replaced.
+    Only IMAGE_VARIANT_SIZES are accepted, so odd sizes can't evict the real thumbnails.
+    """
+    if resize_val not in IMAGE_VARIANT_SIZES:
+        raise ValueError(f"Unsupported image variant size: {resize_val}")
+    with open(ensure_image_variant(image, resize_val, fmt), "rb") as f:
+        return f.read()
+
+def prerender_image_variants(img_path: str):
+    """Encodes the WebP variants the gallery requests, so serving never has to."""
+    image = os.path.basename(img_path)
+    for resize_val in IMAGE_VARIANT_SIZES:
+        render_image_variant(img_path, resize_val, "webp", image_cache_path(image, resize_val, "webp"))
+
+def compile_url_template(template: str):
+    """
+    Parses a str.format style URL template once and returns a function that fills it in.
+    Templates that use format specs or conversions fall back to str.format_map.
+    """
+    parts = list(string.Formatter().parse(template))
+    if any(spec or conversion for _, _, spec, conversion in parts):
+        return lambda **values: template.format_map(values)
+
+    def render(**values) -> str:
+        return "".join(
+            literal if field is None else literal + str(values[field])
+            for literal, field, _, _ in parts
+        )
+    return render
+
+IMAGE_GENERATOR_URL = compile_url_template(IMAGE_GENERATOR_URL_TEMPLATE) if IMAGE_GENERATOR_URL_TEMPLATE else None
+
+def create_http_client() -> httpx.AsyncClient:
+    """Creates the pooled client shared by all image generator requests."""
+    return httpx.AsyncClient(
+        timeout=300.0,
+        # HTTP/2 multiplexes requests over one connection when the optional h2 package is present.
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    )
+
+async def generate_wallpaper(client: httpx.AsyncClient, sem: asyncio.Semaphore, prompt: str, width: int, height: int) -> Optional[tuple[str, int]]:
     seed = random.randint(0, 1_000_000_000)
-    if not IMAGE_GENERATOR_URL_TEMPLATE:
+    if not IMAGE_GENERATOR_URL:
         Log.error("IMAGE_GENERATOR_URL_TEMPLATE is not set.")
         return None
     
-    encoded_prompt = httpx.URL(prompt).path
-    api_url = IMAGE_GENERATOR_URL_TEMPLATE.format_map({
-        "prompt": encoded_prompt,
-        "width": width,
-        "height": height,
-        "seed": seed
-    })
+    # The prompt is embedded as a path segment, so "/" and "?" must be escaped too.
+    encoded_prompt = quote(prompt, safe='')
+    api_url = IMAGE_GENERATOR_URL(prompt=encoded_prompt, width=width, height=height, seed=seed)
     try:
-        async with httpx.AsyncClient(timeout=300.0) as client:
+        async with sem:
             response = await client.get(api_url)
             response.raise_for_status()
             
@@ -614,11 +1107,25 @@ async def generate_wallpaper(prompt: str, width: int, height: int) -> Optional[t
             os.makedirs(LOCAL_WALLPAPER_PATH, exist_ok=True)
             with open(filename, "wb") as f:
                 f.write(image_bytes)
-            return filename, seed
+        # Images are immutable, so encode the served formats once, off the event loop.
+        try:
+            await asyncio.to_thread(prerender_image_variants, filename)
+        except Exception as e:
+            Log.warning(f"Could not pre-render variants for {os.path.basename(filename)}: {e}")
+        return filename, seed
     except Exception as e:
         Log.error(f"Failed to generate wallpaper for prompt '{prompt[:50]}...': {e}")
         return None
 
+def build_image_rows(topic_id: int, prompts: List[str], results) -> List[tuple]:
+    """Turns generate_wallpaper results into INSERT_IMAGE_SQL rows, skipping failures."""
+    rows = []
+    for prompt, result in zip(prompts, results):
+        if result and not isinstance(result, BaseException):
+            image_filename, seed = result
+            rows.append((topic_id, os.path.basename(image_filename), prompt, 1280, 768, seed))
+    return rows
+
 # --- CLI Generation Logic ---
 async def run_cli_generate(args):
     """Handles the image generation process from the command line."""
@@ -629,32 +1136,25 @@ async def run_cli_generate(args):
         Log.error("Failed to generate prompts. Process stopped.")
         return
 
-    db = sqlite3.connect(LOCAL_DATABASE_PATH)
+    db = connect_db()
     cur = db.cursor()
-    cur.execute("INSERT OR IGNORE INTO topic (name) VALUES (?)", (args.topic_name,))
-    db.commit()
-    cur.execute("SELECT id FROM topic WHERE name = ?", (args.topic_name,))
+    cur.execute(UPSERT_TOPIC_SQL, (args.topic_name,))
     topic_id = cur.fetchone()[0]
-
-    generated_count = 0
-    with tqdm(total=len(prompts), desc="Generating Wallpapers") as pbar:
-        for prompt in prompts:
-            pbar.set_description(f"Generating: {prompt[:45]}...")
-            try:
-                result = await generate_wallpaper(prompt, 1280, 768)
-                if result:
-                    image_filename, seed = result
-                    image_filename_base = os.path.basename(image_filename)
-                    cur.execute(
-                        "INSERT OR IGNORE INTO image (topic_id, image, prompt, width, height, seed) VALUES (?, ?, ?, ?, ?, ?)",
-                        (topic_id, image_filename_base, prompt, 1280, 768, seed)
-                    )
-                    generated_count += 1
-            except Exception as e:
-                tqdm.write(f"{Log.FAIL}An error occurred while processing prompt: {prompt[:40]}... Error: {e}{Log.ENDC}")
-            pbar.update(1)
-
     db.commit()
+
+    sem = asyncio.Semaphore(max(1, args.concurrency))
+    async with create_http_client() as client:
+        results = await atqdm.gather(
+            *[generate_wallpaper(client, sem, prompt, 1280, 768) for prompt in prompts],
+            desc="Generating Wallpapers",
+        )
+
+    rows = build_image_rows(topic_id, prompts, results)
+    generated_count = len(rows)
+    # Flush in blocks so one transaction covers many rows.
+    for start in range(0, len(rows), DB_INSERT_BATCH_SIZE):
+        with db:
+            cur.executemany(INSERT_IMAGE_SQL, rows[start:start + DB_INSERT_BATCH_SIZE])
     db.close()
 
     Log.success(f"Process finished. {Log.highlight(generated_count)}/{Log.highlight(len(prompts))} images successfully created.")
@@ -667,15 +1167,29 @@ async def lifespan(app):
     os.makedirs(DATA_PATH, exist_ok=True)
     os.makedirs(LOCAL_WALLPAPER_PATH, exist_ok=True)
     init_db()
+    await asyncio.to_thread(DB_POOL.warmup)
+    optimize_task = asyncio.create_task(optimize_db_periodically())
+    app.state.http = create_http_client()
+    app.state.generate_sem = asyncio.Semaphore(WEB_WALLPAPER_CONCURRENCY)
     Log.success("Application is ready. Manual synchronization is available.")
     yield
+    optimize_task.cancel()
+    await app.state.http.aclose()
+    DB_POOL.close()
     Log.info("Application shutting down.")
 
 app = FastAPI(title="WPG", description="Wallpaper Dataset Generator", lifespan=lifespan)
 
 app.add_middleware(GZipMiddleware)
 
-templates = Jinja2Templates(env=Environment(loader=BaseLoader()))
+templates = Jinja2Templates(env=TEMPLATE_ENV)
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PARTIAL_CACHE_CONTROL = "private, no-cache" # Always revalidate; a matching ETag is a DB-free 304
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match", "")
+    return etag in (tag.strip() for tag in if_none_match.split(","))
 
 @app.get("/wp/{image}")
 async def serve_image(request: Request, image: str):
@@ -683,101 +1197,133 @@ async def serve_image(request: Request, image: str):
     if not os.path.exists(img_path):
         return Response(status_code=404)
         
-    img = Image.open(img_path)
-    
     # Handle resizing request
     resize = request.query_params.get("resize")
-    if resize and resize.isdigit():
-        resize_val = int(resize)
-        img.thumbnail((resize_val, resize_val), Image.Resampling.LANCZOS)
-        
-    img_bytes = io.BytesIO()
+    resize_val = int(resize) if resize and resize.isdigit() else 0
+    # Every distinct size would become a new cache file, so only the sizes the UI uses are accepted.
+    if resize_val not in IMAGE_VARIANT_SIZES:
+        return Response(status_code=400)
+
     is_download = request.query_params.get("download", False)
     if is_download:
-        img.save(img_bytes, format="PNG")
-        img_bytes.seek(0)
-        return Response(content=img_bytes.read(), media_type="image/png", headers={"Content-Disposition": f"attachment; filename={image}"})
+        def encode_png():
+            img_bytes = io.BytesIO()
+            open_thumbnail(img_path, resize_val).save(img_bytes, format="PNG")
+            return img_bytes.getvalue()
+        content = await asyncio.to_thread(encode_png)
+        return Response(content=content, media_type="image/png", headers={"Content-Disposition": f"attachment; filename={image}"})
     
     accept_header = request.headers.get("accept", "")
     
     # Check if the client's browser accepts the WebP format
     if "image/webp" in accept_header:
-        # Serve compressed WebP for modern browsers
-        # The 'quality' parameter (1-100) adjusts compression. 80 is a good balance.
-        img.save(img_bytes, format="WEBP", quality=80)
-        media_type = "image/webp"
+        fmt, media_type = "webp", "image/webp"
     else:
         # Fallback to PNG for older clients
-        img.save(img_bytes, format="PNG")
-        media_type = "image/png"
-        
-    img_bytes.seek(0)
-    
-    # Return the image with appropriate content type and cache headers
-    return Response(
-        content=img_bytes.read(), 
-        media_type=media_type, 
-        headers={"Cache-Control": "max-age=3600"} # Cache for 1 hour
-    )
+        fmt, media_type = "png", "image/png"
+
+    # Filenames are UUIDs and wallpapers never change after generation,
+    # so the name, size and format fully identify the response body.
+    etag = f'"{image}-{resize_val}-{fmt}"'
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL, "Vary": "Accept"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    if resize_val:
+        # Thumbnails are small and requested by every gallery page, so keep them in RAM.
+        content = await asyncio.to_thread(load_image_variant, image, resize_val, fmt)
+        return Response(content=content, media_type=media_type, headers=headers)
+
+    # Decoding and encoding a cache miss is CPU-bound; keep it off the event loop.
+    cache_path = await asyncio.to_thread(ensure_image_variant, image, resize_val, fmt)
+    return FileResponse(cache_path, media_type=media_type, headers=headers)
 
 @app.get("/api/topic", response_class=HTMLResponse)
-async def api_get_topics(request: Request, db: sqlite3.Connection = Depends(get_db), page: int = 1):
+async def api_get_topics(request: Request, db: sqlite3.Connection = Depends(get_db), page: int = 1,
+                         after_name: Optional[str] = None, before_name: Optional[str] = None):
     ITEMS_PER_PAGE = 20
     
     # Pastikan halaman tidak kurang dari 1
     page = max(1, page)
-    offset = (page - 1) * ITEMS_PER_PAGE
 
-    # Dapatkan jumlah total topik
-    total_topics_query = db.execute("SELECT COUNT(*) FROM topic").fetchone()
-    total_topics = total_topics_query[0] if total_topics_query else 0
-    total_pages = math.ceil(total_topics / ITEMS_PER_PAGE) if total_topics > 0 else 1
-    
-    # Ambil topik untuk halaman saat ini
-    topics_query = "SELECT * FROM topic ORDER BY name LIMIT ? OFFSET ?"
-    topics = db.execute(topics_query, (ITEMS_PER_PAGE, offset)).fetchall()
-
-    return TOPIC_LIST_PARTIAL.render(
-        request=request,
-        topics=topics,
-        current_page=page,
-        total_pages=total_pages
+    # Repeated pagination clicks are served from rendered HTML until the data changes.
+    fragment_key = ("topics", content_version(), page, after_name, before_name)
+    # Let htmx/browser revalidate for free: a matching ETag costs no DB work at all.
+    cache_headers = {"ETag": fragment_etag(fragment_key), "Cache-Control": PARTIAL_CACHE_CONTROL}
+    if etag_matches(request, cache_headers["ETag"]):
+        return Response(status_code=304, headers=cache_headers)
+    html = FRAGMENT_CACHE.get(fragment_key)
+    if html is not None:
+        return HTMLResponse(content=html, headers=cache_headers)
+
+    # Ambil topik untuk halaman saat ini, seeking from the neighbouring page's boundary name
+    # The LIMIT+1 probe answers has_next/has_prev, so no COUNT(*) is needed.
+    if before_name is not None:
+        topics, has_prev = await asyncio.to_thread(
+            fetch_keyset_page, db, TOPICS_PAGE_BEFORE_SQL, (before_name,), ITEMS_PER_PAGE, reverse=True
+        )
+        has_next = True
+    else:
+        if after_name is not None:
+            topics, has_next = await asyncio.to_thread(
+                fetch_keyset_page, db, TOPICS_PAGE_AFTER_SQL, (after_name,), ITEMS_PER_PAGE
+            )
+        else:
+            topics, has_next = await asyncio.to_thread(
+                fetch_keyset_page, db, TOPICS_FIRST_PAGE_SQL, (), ITEMS_PER_PAGE
+            )
+        has_prev = after_name is not None
+    if not has_prev:
+        page = 1
+
+    return stream_fragment(
+        TOPIC_LIST_PARTIAL, fragment_key, cache_headers, {
+            "topics": topics,
+            "current_page": page,
+            "has_prev": has_prev and bool(topics),
+            "has_next": has_next and bool(topics),
+            "prev_cursor": topics[0]['name'] if topics else None,
+            "next_cursor": topics[-1]['name'] if topics else None,
+        }
     )
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request, db: sqlite3.Connection = Depends(get_db)):
-    return INDEX_TEMPLATE.render(request=request)
+    return INDEX_HTML
 
 @app.post("/generate", response_class=JSONResponse)
-async def generate_images_api(response: Response, topic_name: str = Form(...), num_images: int = Form(...), db: sqlite3.Connection = Depends(get_db)):
+async def generate_images_api(request: Request, response: Response, topic_name: str = Form(...), num_images: int = Form(...), db: sqlite3.Connection = Depends(get_db)):
     if not topic_name:
         return JSONResponse(content={"error": "Topic name cannot be empty."}, status_code=400)
+    # Bound the work (and the DB write) a single form post can trigger.
+    num_images = max(1, min(num_images, WEB_MAX_IMAGES_PER_REQUEST))
     prompts = await generate_prompts(topic_name, num_images)
     
     if not prompts:
         return JSONResponse(content={"error": "Failed to generate prompts."}, status_code=500)
 
-    cur = db.cursor()
-    cur.execute("INSERT OR IGNORE INTO topic (name) VALUES (?)", (topic_name,))
-    db.commit()
-    cur.execute("SELECT id FROM topic WHERE name = ?", (topic_name,))
-    topic_id = cur.fetchone()['id']
+    def upsert_topic():
+        with db:
+            return db.execute(UPSERT_TOPIC_SQL, (topic_name,)).fetchone()['id']
+    topic_id = await asyncio.to_thread(upsert_topic)
 
-    generated_count = 0
-    for index, prompt in enumerate(prompts):
-        try:
-            result = await generate_wallpaper(prompt, 1280, 768)
-            if result:
-                image_filename, seed = result
-                image_filename_base = os.path.basename(image_filename)
-                cur.execute(
-                    "INSERT OR IGNORE INTO image (topic_id, image, prompt, width, height, seed) VALUES (?, ?, ?, ?, ?, ?)",
-                    (topic_id, image_filename_base, prompt, 1280, 768, seed)
-                )
-                generated_count += 1
-        except Exception as e:
+    sem = request.app.state.generate_sem
+    results = await asyncio.gather(
+        *[generate_wallpaper(request.app.state.http, sem, prompt, 1280, 768) for prompt in prompts],
+        return_exceptions=True
+    )
+    for index, result in enumerate(results):
+        if isinstance(result, Exception):
             Log.error(f"An error occurred while generating wallpaper: {index}")
-    db.commit()
+
+    rows = build_image_rows(topic_id, prompts, results)
+    generated_count = len(rows)
+    # One transaction and one executemany for the whole request.
+    def insert_rows():
+        with db:
+            db.executemany(INSERT_IMAGE_SQL, rows)
+    await asyncio.to_thread(insert_rows)
+    bump_content_version()
 
     if generated_count > 0:
         response.headers["HX-Trigger"] = "newTopicGenerated"
@@ -791,40 +1337,74 @@ async def sync_hf_api():
         return JSONResponse(content={"error": "HF_DATASET_REPO_ID is not set."}, status_code=400)
     try:
         await sync_with_huggingface(HF_DATASET_REPO_ID)
+        bump_content_version() # The merge may have added topics and images anywhere.
         return JSONResponse(content={"message": "Synchronization with Hugging Face was successful."})
     except Exception as e:
         Log.error(f"Error during manual sync: {e}")
         return JSONResponse(content={"error": f"Synchronization failed: {e}"}, status_code=500)
 
 @app.get("/api/topics/{topic_id}/images", response_class=HTMLResponse)
-async def api_get_images_for_topic(request: Request, topic_id: int, db: sqlite3.Connection = Depends(get_db), page: int = 1):
+async def api_get_images_for_topic(request: Request, topic_id: int, db: sqlite3.Connection = Depends(get_db), page: int = 1,
+                                   before_created_at: Optional[str] = None, before_id: Optional[int] = None,
+                                   after_created_at: Optional[str] = None, after_id: Optional[int] = None):
     IMAGES_PER_PAGE = 12 # Jumlah gambar yang wajar per halaman galeri
 
     page = max(1, page)
-    offset = (page - 1) * IMAGES_PER_PAGE
+
+    fragment_key = ("images", content_version(), topic_id, page, before_created_at, before_id, after_created_at, after_id)
+    # Let htmx/browser revalidate for free: a matching ETag costs no DB work at all.
+    cache_headers = {"ETag": fragment_etag(fragment_key), "Cache-Control": PARTIAL_CACHE_CONTROL}
+    if etag_matches(request, cache_headers["ETag"]):
+        return Response(status_code=304, headers=cache_headers)
+    html = FRAGMENT_CACHE.get(fragment_key)
+    if html is not None:
+        return HTMLResponse(content=html, headers=cache_headers)
 
     # Dapatkan info topik
-    topic = db.execute("SELECT name FROM topic WHERE id = ?", (topic_id,)).fetchone()
+    topic = await db_fetchone(db, TOPIC_NAME_SQL, (topic_id,))
     if not topic:
         return HTMLResponse(content='<div class="p-4 text-red-400">Topic not found.</div>', status_code=404)
     topic_name = topic['name']
 
-    # Hitung jumlah total gambar untuk topik ini
-    total_images_query = db.execute("SELECT COUNT(*) FROM image WHERE topic_id = ?", (topic_id,)).fetchone()
-    total_images = total_images_query[0] if total_images_query else 0
-    total_pages = math.ceil(total_images / IMAGES_PER_PAGE) if total_images > 0 else 1
-
     # Ambil gambar untuk halaman saat ini
-    images_query = "SELECT * FROM image WHERE topic_id = ? ORDER BY created_at DESC LIMIT ? OFFSET ?"
-    images = db.execute(images_query, (topic_id, IMAGES_PER_PAGE, offset)).fetchall()
+    count_args = (IMAGES_COUNT_SQL, (topic_id,))
+    if after_created_at is not None and after_id is not None:
+        images, has_prev, total_images = await asyncio.to_thread(
+            fetch_page_with_total, db, *count_args, IMAGES_PAGE_AFTER_SQL,
+            (topic_id, after_created_at, after_id), IMAGES_PER_PAGE, reverse=True
+        )
+        has_next = True
+    else:
+        has_cursor = before_created_at is not None and before_id is not None
+        if has_cursor:
+            images, has_next, total_images = await asyncio.to_thread(
+                fetch_page_with_total, db, *count_args, IMAGES_PAGE_BEFORE_SQL,
+                (topic_id, before_created_at, before_id), IMAGES_PER_PAGE
+            )
+        else:
+            images, has_next, total_images = await asyncio.to_thread(
+                fetch_page_with_total, db, *count_args, IMAGES_FIRST_PAGE_SQL,
+                (topic_id,), IMAGES_PER_PAGE
+            )
+        has_prev = has_cursor
+    if not has_prev:
+        page = 1
 
-    return IMAGE_GALLERY_PARTIAL.render(
-        request=request,
-        images=images,
-        topic_name=topic_name,
-        topic_id=topic_id, # Teruskan topic_id untuk link paginasi
-        current_page=page,
-        total_pages=total_pages
+    # Hitung jumlah total gambar untuk topik ini
+    total_pages = max(1, (total_images + IMAGES_PER_PAGE - 1) // IMAGES_PER_PAGE)
+
+    return stream_fragment(
+        IMAGE_GALLERY_PARTIAL, fragment_key, cache_headers, {
+            "images": images,
+            "topic_name": topic_name,
+            "topic_id": topic_id, # Teruskan topic_id untuk link paginasi
+            "current_page": page,
+            "total_pages": total_pages,
+            "has_prev": has_prev and bool(images),
+            "has_next": has_next and bool(images),
+            "prev_cursor": images[0] if images else None,
+            "next_cursor": images[-1] if images else None,
+        }
     )
 
 def main():
@@ -832,6 +1412,7 @@ def main():
     parser = argparse.ArgumentParser(description="WPG - Wallpaper Dataset Generator")
     parser.add_argument('topic_name', nargs='?', default=None, help='Topic name or \"sync\" command.')
     parser.add_argument('--num', type=int, default=10, help='Number of wallpapers to generate.')
+    parser.add_argument('--concurrency', type=int, default=WALLPAPER_CONCURRENCY, help='Maximum number of concurrent image generator requests.')
     args = parser.parse_args()
 
     os.makedirs(DATA_PATH, exist_ok=True)